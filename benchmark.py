@@ -0,0 +1,424 @@
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from bs4 import BeautifulSoup
+from docx import Document
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def load_fetch_links():
+    # fetch-links.py isn't importable by name because of the dash
+    filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fetch-links.py")
+    spec = importlib.util.spec_from_file_location("fetch_links", filepath)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["fetch_links"] = module
+    spec.loader.exec_module(module)
+    return module
+
+fetch_links = load_fetch_links()
+
+
+def legacy_extract_links(html_content):
+    # process_html_file as it was with BeautifulSoup, kept unchanged as the reference for speed and results;
+    # only the prints are left out and the tags are turned into hrefs for the comparison
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    if not fetch_links.RU_CONTENTS_PATTERN.search(str(soup)):
+        return []
+
+    links = soup.find_all('a', href=True)
+    resulting_links = []
+
+    for link in links:
+        for ex in fetch_links.FILE_EXT:
+            if link['href'].endswith(ex):
+                resulting_links.append(link)
+
+    links = []
+    if len(resulting_links) > 10:
+        for link in resulting_links:
+            for anch_text in fetch_links.ANCHOR_TEXT:
+                if anch_text in str(link):
+                    links.append(link)
+
+    return [link['href'] for link in links]
+
+
+def read_pages(paths):
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in files:
+                    if file.endswith(('.zip', '.html')):
+                        pages.extend(read_pages([os.path.join(root, file)]))
+        elif path.endswith('.zip'):
+            with zipfile.ZipFile(path) as zip_arch_file:
+                for file_info in zip_arch_file.infolist():
+                    if file_info.filename.endswith('.html'):
+                        pages.append((f"{path}/{file_info.filename}", zip_arch_file.read(file_info)))
+        else:
+            with open(path, 'rb') as html_file:
+                pages.append((path, html_file.read()))
+    return pages
+
+
+def time_link_extractor(extract, pages, rounds):
+    results = {}
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(rounds):
+            for name, html_content in pages:
+                results[name] = extract(html_content, name)
+    return time.perf_counter() - started, results
+
+
+def bench_html(pages, rounds):
+    total_size = sum(len(html_content) for _, html_content in pages)
+    print(f"{len(pages)} pages, {total_size / 1024 / 1024:.1f} MB, {rounds} rounds")
+
+    legacy_time, legacy_results = time_link_extractor(lambda html_content, name: legacy_extract_links(html_content), pages, rounds)
+    fast_time, fast_results = time_link_extractor(fetch_links.extract_links, pages, rounds)
+
+    for label, elapsed in (("beautifulsoup", legacy_time), ("extract_links", fast_time)):
+        print(
+            f"{label:>14}: {len(pages) * rounds / elapsed:10.1f} pages/s, "
+            f"{total_size * rounds / elapsed / 1024 / 1024:8.2f} MB/s"
+        )
+    print(f"speedup: {legacy_time / fast_time:.1f}x")
+
+    # the old code repeats a link once per keyword it contains, only distinct links are compared
+    mismatches = [name for name in legacy_results if set(legacy_results[name]) != set(fast_results[name])]
+    # the old code dropped every link of a page with 10 or fewer of them, extract_links keeps them on purpose
+    few_links = [name for name in mismatches if not legacy_results[name] and len(fast_results[name]) <= 10]
+    mismatches = [name for name in mismatches if name not in few_links]
+    print(f"pages with up to 10 file links, dropped by the old code: {len(few_links)}")
+    print(f"pages with different links: {len(mismatches)}")
+    for name in mismatches[:10]:
+        print(f"  {name}: beautifulsoup {sorted(set(legacy_results[name]))}, extract_links {sorted(set(fast_results[name]))}")
+
+
+# offline fixture corpus
+
+SAMPLE_TEXT = "Договор оферты. Условия использования сервиса и политика конфиденциальности. "
+SAMPLE_TEXT_ASCII = "Public offer agreement. Terms of use and privacy policy of the service. "
+DOCUMENT_TYPES = ('.pdf', '.docx', '.rtf', '.csv', '.xlsx')
+
+def make_pdf(size):
+    lines = [SAMPLE_TEXT_ASCII] * max(1, size // len(SAMPLE_TEXT_ASCII))
+    pages = [lines[i:i + 50] for i in range(0, len(lines), 50)]
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for page_lines in pages:
+        content = b"BT /F1 10 Tf 40 800 Td 12 TL " + b" ".join(b"(" + line.encode('ascii') + b") '" for line in page_lines) + b" ET"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (len(objects))
+        )
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(page_refs) + b"] /Count %d >>" % len(page_refs)
+
+    pdf = BytesIO()
+    pdf.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(pdf.tell())
+        pdf.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = pdf.tell()
+    pdf.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        pdf.write(b"%010d 00000 n \n" % offset)
+    pdf.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return pdf.getvalue()
+
+def make_docx(size):
+    doc = Document()
+    for _ in range(max(1, size // len(SAMPLE_TEXT.encode('utf-8')))):
+        doc.add_paragraph(SAMPLE_TEXT)
+    docx = BytesIO()
+    doc.save(docx)
+    return docx.getvalue()
+
+def make_rtf(size):
+    line = SAMPLE_TEXT_ASCII + "\\par\n"
+    return ("{\\rtf1\\ansi\\deff0 " + line * max(1, size // len(line)) + "}").encode('utf-8')
+
+def make_table(size):
+    rows = max(1, size // 60)
+    return pd.DataFrame({
+        'id': range(rows),
+        'name': [f"услуга {i}" for i in range(rows)],
+        'price': [i * 100.5 for i in range(rows)],
+    })
+
+def make_csv(size):
+    return make_table(size).to_csv(index=False).encode('utf-8')
+
+def make_xlsx(size):
+    xlsx = BytesIO()
+    make_table(size).to_excel(xlsx, index=False)
+    return xlsx.getvalue()
+
+DOCUMENT_MAKERS = {'.pdf': make_pdf, '.docx': make_docx, '.rtf': make_rtf, '.csv': make_csv, '.xlsx': make_xlsx}
+
+def make_documents(size):
+    return {f"/docs/sample{ext}": DOCUMENT_MAKERS[ext](size) for ext in DOCUMENT_TYPES}
+
+def make_page(base_url, links, seed):
+    rnd = random.Random(seed)
+    parts = [
+        "<html><head><meta charset='utf-8'><title>Компания</title>"
+        # markup inside scripts and comments isn't a link
+        f"<script>document.write(\"<a href='{base_url}/docs/script/sample.pdf'>Договор</a>\");</script>"
+        "</head><body>"
+    ]
+    for i in range(links):
+        parts.append(f"<div class='block{i}'><p>{SAMPLE_TEXT}</p><a href='/about{i}.html'>О компании</a></div>")
+        ext = rnd.choice(DOCUMENT_TYPES)
+        anchor = rnd.choice(("Публичный договор оферты", "Политика конфиденциальности", "Скачать", "Прайс"))
+        # every link is a distinct url, the server answers by file name only
+        href = f"{base_url}/docs/{seed}/{i}/sample{ext}"
+        parts.append(rnd.choice((
+            f"<a href='{href}'>{anchor}</a>",
+            f'<a class="doc" href="{href}">{anchor}</a>',
+            f"<a href={href} target=_blank>{anchor}</a>",
+            f'<a title="скачать -> {anchor}" href="{href}">{anchor}</a>',
+        )))
+        if rnd.random() < 0.1:
+            parts.append(f"<!-- <a href='{base_url}/docs/comment/sample.pdf'>Договор</a> -->")
+    parts.append("</body></html>")
+    return "".join(parts).encode('utf-8')
+
+# markup the link extractor got wrong once, every page has more than 10 links so that the keyword filter runs
+TRICKY_MARKUP = {
+    'greater-than in an attribute': '<a title="a>b" href="/tricky/gt.pdf">Договор</a>',
+    'link in a script': "<script>var s = \"<a href='/tricky/script.pdf'>Договор</a>\";</script>",
+    'link in a style': "<STYLE type='text/css'>/* <a href='/tricky/style.pdf'>Договор</a> */</STYLE >",
+    'comment inside a script': "<script>var s = '<!--';</script><a href='/tricky/after-script.pdf'>Договор</a>",
+    'href inside another attribute': "<a data-x='href=/tricky/no.pdf' href=/tricky/yes.pdf>Договор</a>",
+    'unclosed comment': "<a href='/tricky/before.pdf'>Договор</a><!-- <a href='/tricky/comment.pdf'>Договор</a>",
+    'unclosed script': "<a href='/tricky/before.pdf'>Договор</a><script><a href='/tricky/unclosed.pdf'>Договор</a>",
+}
+
+def make_tricky_pages():
+    links = "".join(f"<p>{SAMPLE_TEXT}</p><a href='/docs/{i}/offer.pdf'>Договор оферты</a>" for i in range(11))
+    return [
+        (f"tricky: {name}", f"<html><body>{links}{markup}".encode('utf-8'))
+        for name, markup in TRICKY_MARKUP.items()
+    ]
+
+def generate_sites(directory, base_url, sites, pages, links):
+    os.makedirs(directory, exist_ok=True)
+    for site in range(sites):
+        with zipfile.ZipFile(os.path.join(directory, f"site{site}.zip"), 'w', zipfile.ZIP_DEFLATED) as zip_arch_file:
+            for page in range(pages):
+                zip_arch_file.writestr(f"page{page}.html", make_page(base_url, links, site * pages + page))
+
+
+# local stand-in for the crawled sites
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle on every reused connection waits for a delayed ack
+    disable_nagle_algorithm = True
+    documents = {}
+    latency = 0.0
+
+    def send_document(self, with_body):
+        time.sleep(self.latency)
+        body = self.documents.get("/docs/" + self.path.split('?', 1)[0].rsplit('/', 1)[-1])
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_document(with_body=True)
+
+    def do_HEAD(self):
+        self.send_document(with_body=False)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(documents, latency):
+    handler = type("Handler", (FixtureHandler,), {'documents': documents, 'latency': latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# stages
+
+def peak_rss():
+    if resource is None:
+        return "n/a"
+    # kilobytes on linux, bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return f"{own / 1024 / 1024:.0f} MB (largest child {children / 1024 / 1024:.0f} MB)"
+
+def report(stage, amount, unit, elapsed, extra=""):
+    print(f"{stage:>12}: {amount / elapsed:10.1f} {unit}/s, {elapsed:7.2f}s{extra}, peak rss {peak_rss()}")
+
+def bench_html_stage(site_directory, rounds):
+    pages = read_pages([site_directory])
+    total_size = sum(len(html_content) for _, html_content in pages)
+    elapsed, _ = time_link_extractor(fetch_links.extract_links, pages, rounds)
+    report("html", len(pages) * rounds, "pages", elapsed, f", {total_size * rounds / elapsed / 1024 / 1024:.1f} MB/s")
+
+def bench_download_stage(base_url, documents, downloads):
+    # extraction is replaced by a no-op, only the network side is measured
+    submit_extraction = fetch_links.submit_extraction
+    fetch_links.submit_extraction = lambda filename, document: fetch_links.completed(len(document))
+    urls = [f"{base_url}/docs/{i}/{os.path.basename(path)}" for i, path in zip(range(downloads), list(documents) * downloads)]
+    try:
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            futures = [fetch_links.submit_download(url, os.path.basename(url)) for url in urls]
+            sizes = [fetch_links.document_text(future) or 0 for future in futures]
+        elapsed = time.perf_counter() - started
+    finally:
+        fetch_links.submit_extraction = submit_extraction
+    report("download", downloads, "downloads", elapsed, f", {sum(sizes) / elapsed / 1024 / 1024:.1f} MB/s")
+
+def bench_extraction_stage(documents, rounds):
+    for path, document in documents.items():
+        started = time.perf_counter()
+        for _ in range(rounds):
+            fetch_links.extract_text(path, document)
+        elapsed = time.perf_counter() - started
+        report(f"extract {os.path.splitext(path)[1]}", len(document) * rounds / 1024 / 1024, "MB", elapsed)
+
+    # the same documents through the process pool, all cores
+    total_size = sum(len(document) for document in documents.values()) * rounds
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        extractions = [
+            fetch_links.submit_extraction(path, document) for _ in range(rounds) for path, document in documents.items()
+        ]
+        for extraction in extractions:
+            extraction.result()
+    elapsed = time.perf_counter() - started
+    # pool workers only count in RUSAGE_CHILDREN once they have exited
+    fetch_links.shutdown_extraction_executor()
+    report("extract pool", total_size / 1024 / 1024, "MB", elapsed, f", {fetch_links.EXTRACT_WORKERS} workers")
+
+def bench_pipeline(site_directory, work_directory, sites):
+    fetch_links.PROGRESS_DB = os.path.join(work_directory, "progress.db")
+    fetch_links.SCRATCH_DIRECTORY = os.path.join(work_directory, "tmp")
+    fetch_links.progress_connection = None
+
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        fetch_links.process_directory(site_directory)
+    elapsed = time.perf_counter() - started
+    report("pipeline", sites, "sites", elapsed, f", {fetch_links.ARCHIVE_WORKERS} archive workers")
+
+def run_benchmarks(args):
+    work_directory = tempfile.mkdtemp(prefix="fetch-links-bench-")
+    # every run starts cold and leaves nothing behind
+    fetch_links.CACHE_DIRECTORY = None
+    fetch_links.MAX_DOWNLOAD_SIZE = max(fetch_links.MAX_DOWNLOAD_SIZE, args.doc_size * 1024 * 2)
+    # all fixtures come from one host, so this limits the whole download stage
+    fetch_links.DOWNLOADS_PER_HOST = args.per_host
+    fetch_links.METRICS_ENABLED = not args.no_metrics
+    try:
+        documents = make_documents(args.doc_size * 1024)
+        server, base_url = start_server(documents, args.latency / 1000)
+        site_directory = os.path.join(work_directory, "sites")
+        generate_sites(site_directory, base_url, args.sites, args.pages, args.links)
+        print(
+            f"{args.sites} sites x {args.pages} pages x {args.links} links, "
+            f"documents of {args.doc_size} KB, server latency {args.latency} ms"
+        )
+
+        stages = args.stages.split(',')
+        if 'html' in stages:
+            bench_html_stage(site_directory, args.rounds)
+        if 'download' in stages:
+            bench_download_stage(base_url, documents, args.downloads)
+        if 'extract' in stages:
+            bench_extraction_stage(documents, args.rounds)
+        if 'pipeline' in stages:
+            # only the pipeline's own numbers in its progress line
+            fetch_links.take_metrics()
+            bench_pipeline(site_directory, work_directory, args.sites)
+            if fetch_links.METRICS_ENABLED:
+                print(fetch_links.progress_line(fetch_links.metrics))
+        server.shutdown()
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+def serve(args):
+    documents = make_documents(args.doc_size * 1024)
+    server, base_url = start_server(documents, args.latency / 1000)
+    generate_sites(args.directory, base_url, args.sites, args.pages, args.links)
+    print(f"{args.sites} site zips in {args.directory}, documents served from {base_url}/docs/, ctrl+c to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fetch-links benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    html_parser = commands.add_parser("html", help="link extraction, BeautifulSoup against extract_links")
+    html_parser.add_argument("paths", nargs="+", help="site zips, .html files or directories with them")
+    html_parser.add_argument("--rounds", type=int, default=3)
+
+    corpus_options = argparse.ArgumentParser(add_help=False)
+    corpus_options.add_argument("--sites", type=int, default=20)
+    corpus_options.add_argument("--pages", type=int, default=10, help="html pages per site zip")
+    corpus_options.add_argument("--links", type=int, default=20, help="document links per page")
+    corpus_options.add_argument("--doc-size", type=int, default=100, help="size of every sample document, KB")
+    corpus_options.add_argument("--latency", type=int, default=50, help="delay of every server response, ms")
+    corpus_options.add_argument("--per-host", type=int, default=16, help="DOWNLOADS_PER_HOST for the run")
+
+    run_parser = commands.add_parser("run", parents=[corpus_options], help="per stage throughput on a synthetic corpus")
+    run_parser.add_argument("--stages", default="html,download,extract,pipeline")
+    run_parser.add_argument("--downloads", type=int, default=200)
+    run_parser.add_argument("--rounds", type=int, default=3)
+    run_parser.add_argument("--no-metrics", action="store_true", help="run with METRICS_ENABLED off, to see its overhead")
+
+    serve_parser = commands.add_parser("serve", parents=[corpus_options], help="generate site zips and serve their documents")
+    serve_parser.add_argument("directory")
+
+    args = parser.parse_args()
+    if args.command == "html":
+        bench_html(read_pages(args.paths) + make_tricky_pages(), args.rounds)
+    elif args.command == "run":
+        run_benchmarks(args)
+    elif args.command == "serve":
+        serve(args)
@@ -1,87 +1,888 @@
 import os
 import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+import json
+import multiprocessing
 import zipfile
+import zlib
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from hashlib import sha1, sha256
+from io import BytesIO
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock, Timer
+from urllib.parse import urlsplit, urlunsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from ssl import SSLError
 import urllib3
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings()
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 import patoolib
+import rarfile
 from PyPDF2 import PdfReader
 from docx import Document
 from striprtf.striprtf import rtf_to_text
-from bs4 import BeautifulSoup
 import pandas as pd
 from humanize import naturalsize
 import re
+from html import unescape
+
+try:
+    import resource
+except ImportError:
+    # windows, extraction runs without memory limit
+    resource = None
 
 FILE_EXT = {'.pdf', '.doc', '.docx', '.rtf', '.csv', '.xls', '.xlsx'}
 ANCHOR_TEXT = {'договор', 'оферт', 'услов', 'политика', 'конфиденц', 'реквизиты', 'соглаш', 'пользов', 'персональн', 'юридич', 'право', 'информ'}
 
-def extract_text_from_pdf(pdf_filepath):
-    with open(pdf_filepath, 'rb') as file:
-        reader = PdfReader(file)
-        return ' '.join([page.extract_text() for page in reader.pages])
+# archive scheduler settings
+ARCHIVE_WORKERS = os.cpu_count() or 1   # processes working on different archives
+ZIPS_PER_TASK = 64                      # site zips lying outside of rars are handed to the workers in batches
+SCRATCH_DIRECTORY = "./tmp"             # every rar is extracted into its own subdirectory here
+RAR_STREAMING = True                    # read site zips out of a rar one by one instead of extracting it whole
+RAR_SPILL_SIZE = 4 * 1024 * 1024        # a streamed site zip bigger than this goes to a temp file in SCRATCH_DIRECTORY,
+                                        # a worker keeps at most (MAX_PENDING_ZIPS + 1) * RAR_SPILL_SIZE of them in memory
+PROGRESS_DB = "./progress.db"
+LEGACY_PROGRESS_FILES = {'archive': "./processed_archives.txt", 'site': "./processed_site_archives.txt"}
+
+# download engine settings, the limits are for the whole run and shared by the archive workers
+DOWNLOAD_WORKERS = 32       # limit of simultaneous downloads, every archive worker runs its share of them
+DOWNLOADS_PER_HOST = 2      # one slow site can't take more than this many workers
+HOST_SLOT_GROUPS = 256      # hosts are hashed into this many shared per host limits, hosts of one group share it
+HOST_RETRY_DELAY = 0.2      # a host busy in other archive workers is tried again after this many seconds
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5      # sleeps 0.5s, 1s, 2s between retries
+MAX_PENDING_ZIPS = 16       # site archives whose downloads may be in flight at the same time
+MAX_DOWNLOAD_SIZE = 3 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+REJECTED_CONTENT_TYPES = ('text/html', 'image/', 'audio/', 'video/')
+PROBE_BEFORE_DOWNLOAD = False   # ask HEAD (or a one byte range) first, for servers that lie in GET headers
+
+# extraction stage settings, per archive worker
+EXTRACT_WORKERS = max(1, (os.cpu_count() or 1) // ARCHIVE_WORKERS)
+EXTRACT_QUEUE_SIZE = 2 * EXTRACT_WORKERS    # downloaded documents waiting for a worker, downloads block when it's full
+EXTRACT_TIMEOUT = 60                        # seconds per document, needs SIGALRM (not on windows)
+EXTRACT_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024   # address space of an extraction worker
+EXTRACT_STATS_EVERY = 100                   # print extraction throughput every N documents
+
+# download cache settings, shared by all site archives and all runs
+CACHE_DIRECTORY = "./cache"                 # None turns the cache off
+CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024     # extracted texts above this size are evicted, least recently used first
+FAILURE_CACHE_TTL = 7 * 24 * 60 * 60        # a document the parsers failed on is tried again after this many seconds
+
+# metrics settings
+METRICS_ENABLED = True                      # timers and counters around every stage, almost free when off
+METRICS_REPORT_EVERY = 60                   # seconds between progress lines of an archive worker
+METRICS_JSON_REPORT = "./run_report.json"
+METRICS_PROMETHEUS_REPORT = "./run_report.prom"
+
+def new_metrics():
+    return {'started': time.time(), 'stages': {}, 'counters': {}, 'hosts': {}}
+
+metrics = new_metrics()
+metrics_lock = Lock()
+metrics_reported = time.monotonic()
+NO_TIMER = nullcontext()
+
+def timed(stage):
+    if not METRICS_ENABLED:
+        return NO_TIMER
+    return stage_timer(stage)
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(stage, time.perf_counter() - started)
+
+def record_time(stage, seconds):
+    if not METRICS_ENABLED:
+        return
+    with metrics_lock:
+        timer = metrics['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+        timer['count'] += 1
+        timer['seconds'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+def count(counter, amount=1):
+    if not METRICS_ENABLED:
+        return
+    with metrics_lock:
+        metrics['counters'][counter] = metrics['counters'].get(counter, 0) + amount
+
+def record_fetch(url, status_code, size, seconds):
+    if not METRICS_ENABLED:
+        return
+    host = urlsplit(url).netloc.lower()
+    with metrics_lock:
+        stats = metrics['hosts'].setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'statuses': {}})
+        stats['requests'] += 1
+        stats['bytes'] += size
+        stats['seconds'] += seconds
+        stats['statuses'][str(status_code)] = stats['statuses'].get(str(status_code), 0) + 1
+
+def take_metrics():
+    # hands the metrics of this process over to the parent and starts counting from zero
+    global metrics
+    with metrics_lock:
+        taken, metrics = metrics, new_metrics()
+    return taken
+
+def merge_metrics(other):
+    with metrics_lock:
+        for stage, timer in other['stages'].items():
+            merged = metrics['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            merged['count'] += timer['count']
+            merged['seconds'] += timer['seconds']
+            merged['max'] = max(merged['max'], timer['max'])
+        for counter, amount in other['counters'].items():
+            metrics['counters'][counter] = metrics['counters'].get(counter, 0) + amount
+        for host, stats in other['hosts'].items():
+            merged = metrics['hosts'].setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'statuses': {}})
+            merged['requests'] += stats['requests']
+            merged['bytes'] += stats['bytes']
+            merged['seconds'] += stats['seconds']
+            for status, amount in stats['statuses'].items():
+                merged['statuses'][status] = merged['statuses'].get(status, 0) + amount
+
+def progress_line(run_metrics):
+    counters = run_metrics['counters']
+    stages = sorted(run_metrics['stages'].items(), key=lambda item: -item[1]['seconds'])
+    fetched = sum(stats['bytes'] for stats in run_metrics['hosts'].values())
+    return (
+        f"progress: {counters.get('sites', 0)} sites, {counters.get('pages', 0)} pages, "
+        f"{counters.get('documents', 0)} documents, {naturalsize(fetched)} fetched, time in "
+        + ", ".join(f"{stage} {timer['seconds']:.1f}s" for stage, timer in stages[:5])
+    )
+
+def maybe_report_progress():
+    global metrics_reported
+    if not METRICS_ENABLED or time.monotonic() - metrics_reported < METRICS_REPORT_EVERY:
+        return
+    metrics_reported = time.monotonic()
+    with metrics_lock:
+        line = progress_line(metrics)
+    print(f"[{os.getpid()}] {line}")
+
+def slowest_hosts(run_metrics, limit=10):
+    hosts = [(stats['seconds'] / stats['requests'], host) for host, stats in run_metrics['hosts'].items() if stats['requests']]
+    return [(host, latency) for latency, host in sorted(hosts, reverse=True)[:limit]]
+
+def prometheus_text(run_metrics):
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
 
-def extract_text_from_docx(docx_file):
-    doc = Document(docx_file)
+    lines = [
+        "# TYPE fetch_links_stage_seconds_total counter",
+        *(f'fetch_links_stage_seconds_total{{stage="{label(stage)}"}} {timer["seconds"]:.6f}'
+          for stage, timer in run_metrics['stages'].items()),
+        "# TYPE fetch_links_stage_calls_total counter",
+        *(f'fetch_links_stage_calls_total{{stage="{label(stage)}"}} {timer["count"]}'
+          for stage, timer in run_metrics['stages'].items()),
+        "# TYPE fetch_links_stage_max_seconds gauge",
+        *(f'fetch_links_stage_max_seconds{{stage="{label(stage)}"}} {timer["max"]:.6f}'
+          for stage, timer in run_metrics['stages'].items()),
+        "# TYPE fetch_links_events_total counter",
+        *(f'fetch_links_events_total{{event="{label(counter)}"}} {amount}'
+          for counter, amount in run_metrics['counters'].items()),
+        "# TYPE fetch_links_http_requests_total counter",
+        *(f'fetch_links_http_requests_total{{host="{label(host)}",status="{status}"}} {amount}'
+          for host, stats in run_metrics['hosts'].items() for status, amount in stats['statuses'].items()),
+        "# TYPE fetch_links_http_bytes_total counter",
+        *(f'fetch_links_http_bytes_total{{host="{label(host)}"}} {stats["bytes"]}'
+          for host, stats in run_metrics['hosts'].items()),
+        "# TYPE fetch_links_http_seconds_total counter",
+        *(f'fetch_links_http_seconds_total{{host="{label(host)}"}} {stats["seconds"]:.6f}'
+          for host, stats in run_metrics['hosts'].items()),
+    ]
+    return "\n".join(lines) + "\n"
+
+def write_run_report():
+    if not METRICS_ENABLED:
+        return
+    with metrics_lock:
+        run_metrics = json.loads(json.dumps(metrics))
+    run_metrics['elapsed'] = time.time() - run_metrics['started']
+    run_metrics['slowest_hosts'] = slowest_hosts(run_metrics)
+
+    print(progress_line(run_metrics))
+    for host, latency in run_metrics['slowest_hosts']:
+        print(f"  slow host {host}: {latency:.2f}s per request")
+
+    with open(METRICS_JSON_REPORT, 'w', encoding='utf-8') as report_file:
+        json.dump(run_metrics, report_file, ensure_ascii=False, indent=2)
+    with open(METRICS_PROMETHEUS_REPORT, 'w', encoding='utf-8') as report_file:
+        report_file.write(prometheus_text(run_metrics))
+    print(f"run report written to {METRICS_JSON_REPORT} and {METRICS_PROMETHEUS_REPORT}")
+
+# extractors take the document contents as bytes/bytearray/memoryview or an open binary file
+
+def as_stream(document):
+    if isinstance(document, (bytes, bytearray, memoryview)):
+        return BytesIO(document)
+    return document
+
+def extract_text_from_pdf(pdf_document):
+    reader = PdfReader(as_stream(pdf_document))
+    return ' '.join([page.extract_text() for page in reader.pages])
+
+def extract_text_from_docx(docx_document):
+    doc = Document(as_stream(docx_document))
     return ' '.join([p.text for p in doc.paragraphs])
 
-def extract_text_from_rtf(rtf_file):
-    with open(rtf_file) as file:
-        content = file.read().decode('utf-8')
-        text = rtf_to_text(content)
-        return text
+def extract_text_from_rtf(rtf_document):
+    content = as_stream(rtf_document).read().decode('utf-8', errors='replace')
+    text = rtf_to_text(content)
+    return text
 
-def extract_text_from_csv(csv_filepath):
-    df = pd.read_csv(csv_filepath)
+def extract_text_from_csv(csv_document):
+    df = pd.read_csv(as_stream(csv_document))
     return df.to_string()
 
-def extract_text_from_excel(excel_filepath):
-    df = pd.read_excel(excel_filepath)
+def extract_text_from_excel(excel_document):
+    df = pd.read_excel(as_stream(excel_document))
     return df.to_string()
 
-def download_and_extract_text(url, target_directory, output_filename, delete_intermidiate_file=False):
-    filename = os.path.join(target_directory, output_filename)
-    print(f"downloading {url} to {filename}")
+def extract_text(filename, document):
+    text = None
+    if filename.endswith('.pdf'):
+        text = extract_text_from_pdf(document)
+    elif filename.endswith('.doc') or filename.endswith('.docx'):
+        text = extract_text_from_docx(document)
+    elif filename.endswith('.rtf'):
+        text = extract_text_from_rtf(document)
+    elif filename.endswith('.csv'):
+        text = extract_text_from_csv(document)
+    elif filename.endswith('.xls') or filename.endswith('.xlsx'):
+        text = extract_text_from_excel(document)
+    return text
+
+def raise_extraction_timeout(signum, frame):
+    raise TimeoutError(f"extraction took longer than {EXTRACT_TIMEOUT}s")
+
+def init_extraction_worker():
+    if resource is not None:
+        # a pathological document gets MemoryError instead of taking the whole machine
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (EXTRACT_MEMORY_LIMIT, hard_limit))
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, raise_extraction_timeout)
+
+def extract_text_with_limits(filename, document):
+    # runs in an extraction worker process, returns the text and the time spent on it
+    if hasattr(signal, 'SIGALRM'):
+        signal.alarm(EXTRACT_TIMEOUT)
     try:
-        response = requests.get(url, verify=False)
-        file_len = response.headers.get('Content-Length', 0)
-        print(f"Response: {response}, {naturalsize(file_len)}")
-
-        if response.status_code == 200 and (int(file_len) <= 3 * 1024 * 1024):
-            print(f"writing {url} to {filename}")
-            with open(filename, 'wb') as file:
-                file.write(response.content)
-
-            text = None
-            if filename.endswith('.pdf'):
-                text = extract_text_from_pdf(filename)
-            elif filename.endswith('.doc') or filename.endswith('.docx'):
-                text = extract_text_from_docx(filename)
-            elif filename.endswith('.rtf'):
-                text = extract_text_from_rtf(filename)
-            elif filename.endswith('.csv'):
-                text = extract_text_from_csv(filename)
-            elif filename.endswith('.xls') or filename.endswith('.xlsx'):
-                text = extract_text_from_excel(filename)
-
-            if delete_intermidiate_file:
-                #print(f"removing {filename}")
-                os.remove(filename)
-
-            if text:
-                txt_filename = filename[:-4] + '.txt'
-                print(f"writing text of {url} to {txt_filename}")
-                with open(txt_filename, 'w', encoding='utf-8') as txt_file:
-                    txt_file.write(text)
+        started = time.perf_counter()
+        text = extract_text(filename, document)
+        return text, time.perf_counter() - started
+    finally:
+        if hasattr(signal, 'SIGALRM'):
+            signal.alarm(0)
+
+extraction_executor = None
+extraction_executor_lock = Lock()
+extraction_slots = BoundedSemaphore(EXTRACT_QUEUE_SIZE)
+extraction_stats = {'submitted': 0, 'done': 0, 'failed': 0, 'bytes': 0, 'blocked': 0, 'wait_time': 0.0, 'started': None}
+extraction_stats_lock = Lock()
+
+def get_extraction_executor():
+    global extraction_executor
+    with extraction_executor_lock:
+        if extraction_executor is None:
+            extraction_executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, initializer=init_extraction_worker)
+            if extraction_stats['started'] is None:
+                extraction_stats['started'] = time.monotonic()
+        return extraction_executor
+
+def restart_extraction_executor(broken_executor):
+    # a worker killed by the os breaks the whole pool, start a new one
+    global extraction_executor
+    with extraction_executor_lock:
+        if extraction_executor is broken_executor:
+            print("extraction pool is broken, restarting it")
+            broken_executor.shutdown(wait=False)
+            extraction_executor = None
+
+def submit_extraction(filename, document):
+    size = len(document)
+
+    started = time.monotonic()
+    extraction_slots.acquire()
+    waited = time.monotonic() - started
+
+    with extraction_stats_lock:
+        extraction_stats['submitted'] += 1
+        extraction_stats['wait_time'] += waited
+        if waited > 0.01:
+            extraction_stats['blocked'] += 1
+
+    try:
+        executor = get_extraction_executor()
+        try:
+            worker_extraction = executor.submit(extract_text_with_limits, filename, document)
+        except BrokenProcessPool:
+            restart_extraction_executor(executor)
+            worker_extraction = get_extraction_executor().submit(extract_text_with_limits, filename, document)
+    except BaseException:
+        # the document never got into the pool, its slot would be lost for good
+        extraction_slots.release()
+        with extraction_stats_lock:
+            extraction_stats['failed'] += 1
+        raise
+
+    # resolves to just the text, the timing goes to the metrics
+    extraction = Future()
+    worker_extraction.add_done_callback(lambda future: extraction_done(future, extraction, filename, size))
+    return extraction
+
+def extraction_done(worker_extraction, extraction, filename, size):
+    extraction_slots.release()
+    succeeded = not worker_extraction.cancelled() and worker_extraction.exception() is None
+    with extraction_stats_lock:
+        if succeeded:
+            extraction_stats['done'] += 1
+            extraction_stats['bytes'] += size
+        else:
+            extraction_stats['failed'] += 1
+        finished = extraction_stats['done'] + extraction_stats['failed']
+
+    extension = os.path.splitext(filename)[1].lower() or 'unknown'
+    if succeeded:
+        text, seconds = worker_extraction.result()
+        record_time(f"extract {extension}", seconds)
+        count('documents')
+        count('extracted bytes', size)
+        extraction.set_result(text)
+    else:
+        count(f"extract {extension} failed")
+        error = None if worker_extraction.cancelled() else worker_extraction.exception()
+        extraction.set_exception(error or BrokenProcessPool("extraction was cancelled"))
+
+    if finished % EXTRACT_STATS_EVERY == 0:
+        report_extraction_stats()
+
+def report_extraction_stats():
+    with extraction_stats_lock:
+        stats = dict(extraction_stats)
+    if stats['started'] is None:
+        return
+
+    elapsed = max(time.monotonic() - stats['started'], 0.001)
+    in_queue = stats['submitted'] - stats['done'] - stats['failed']
+    print(
+        f"extraction: {stats['done']} documents ({stats['failed']} failed), "
+        f"{stats['done'] / elapsed:.2f} docs/s, {naturalsize(stats['bytes'] / elapsed)}/s, "
+        f"in queue {in_queue}/{EXTRACT_QUEUE_SIZE}, "
+        f"downloads blocked {stats['blocked']} times for {stats['wait_time']:.1f}s"
+    )
+
+def shutdown_extraction_executor():
+    global extraction_executor
+    with extraction_executor_lock:
+        if extraction_executor is not None:
+            extraction_executor.shutdown()
+            extraction_executor = None
+
+def document_text(download):
+    try:
+        extraction = download.result()
+        if extraction is not None:
+            return extraction.result()
+    except Exception as e:
+        # a broken pool is restarted by submit_extraction when the next document comes
+        print(e)
+    return None
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, parts.port) in (('http', 80), ('https', 443)):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+cache_connection = None
+cache_lock = Lock()
+
+def get_cache():
+    global cache_connection
+    if cache_connection is None:
+        os.makedirs(os.path.join(CACHE_DIRECTORY, "texts"), exist_ok=True)
+        connection = sqlite3.connect(
+            os.path.join(CACHE_DIRECTORY, "cache.db"), timeout=60, check_same_thread=False, isolation_level=None
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS texts (content_hash TEXT PRIMARY KEY, size INTEGER, last_used REAL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS failures (content_hash TEXT PRIMARY KEY, error TEXT, failed REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS texts_last_used ON texts (last_used)")
+        # running total of texts.size, so storing a text doesn't sum the whole table
+        connection.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)")
+        connection.execute("INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM texts")
+        cache_connection = connection
+    return cache_connection
+
+def cached_text_path(content_hash):
+    return os.path.join(CACHE_DIRECTORY, "texts", content_hash[:2], content_hash + ".txt")
+
+def cache_lookup(url):
+    with cache_lock:
+        return get_cache().execute(
+            "SELECT etag, last_modified, content_hash FROM urls WHERE url = ?", (url,)
+        ).fetchone()
+
+def cache_store_url(url, etag, last_modified, content_hash):
+    with cache_lock:
+        get_cache().execute(
+            "INSERT OR REPLACE INTO urls (url, etag, last_modified, content_hash) VALUES (?, ?, ?, ?)",
+            (url, etag, last_modified, content_hash)
+        )
+
+def cached_text(content_hash):
+    with cache_lock:
+        cache = get_cache()
+        if cache.execute("SELECT 1 FROM texts WHERE content_hash = ?", (content_hash,)).fetchone() is None:
+            return None
+        cache.execute("UPDATE texts SET last_used = ? WHERE content_hash = ?", (time.time(), content_hash))
+
+    try:
+        with open(cached_text_path(content_hash), encoding='utf-8') as txt_file:
+            return txt_file.read()
+    except FileNotFoundError:
+        # evicted by another process in the meantime
+        return None
+
+def cache_store_text(content_hash, text):
+    filename = cached_text_path(content_hash)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as txt_file:
+        txt_file.write(text)
+    os.replace(tmp_filename, filename)
+
+    size = os.path.getsize(filename)
+    with cache_lock:
+        cache = get_cache()
+        # the row and the running total change together, other archive workers write to the same db
+        cache.execute("BEGIN IMMEDIATE")
+        try:
+            replaced = cache.execute("SELECT size FROM texts WHERE content_hash = ?", (content_hash,)).fetchone()
+            cache.execute(
+                "INSERT OR REPLACE INTO texts (content_hash, size, last_used) VALUES (?, ?, ?)",
+                (content_hash, size, time.time())
+            )
+            cache.execute("UPDATE cache_size SET total = total + ? WHERE id = 0", (size - (replaced[0] if replaced else 0),))
+            cache.execute("DELETE FROM failures WHERE content_hash = ?", (content_hash,))
+            evicted = evict_cached_texts(cache)
+            cache.execute("COMMIT")
+        except BaseException:
+            cache.execute("ROLLBACK")
+            raise
+
+    for content_hash in evicted:
+        try:
+            os.remove(cached_text_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+def evict_cached_texts(cache):
+    # returns the hashes whose files are to be removed once the transaction is committed
+    total_size = cache.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+    evicted = []
+    while total_size > CACHE_MAX_SIZE:
+        oldest = cache.execute("SELECT content_hash, size FROM texts ORDER BY last_used LIMIT 100").fetchall()
+        if not oldest:
+            break
+        for content_hash, size in oldest:
+            cache.execute("DELETE FROM texts WHERE content_hash = ?", (content_hash,))
+            evicted.append(content_hash)
+            total_size -= size
+            if total_size <= CACHE_MAX_SIZE:
+                break
+    cache.execute("UPDATE cache_size SET total = ? WHERE id = 0", (max(total_size, 0),))
+    return evicted
+
+def cached_failure(content_hash):
+    with cache_lock:
+        failure = get_cache().execute(
+            "SELECT error FROM failures WHERE content_hash = ? AND failed > ?",
+            (content_hash, time.time() - FAILURE_CACHE_TTL)
+        ).fetchone()
+    return failure[0] if failure else None
+
+def cache_store_failure(content_hash, error):
+    with cache_lock:
+        get_cache().execute(
+            "INSERT OR REPLACE INTO failures (content_hash, error, failed) VALUES (?, ?, ?)",
+            (content_hash, f"{type(error).__name__}: {error}", time.time())
+        )
+
+# errors that depend on the run rather than on the document: the load on the machine (timeouts),
+# the memory limit, missing packages, a pool broken by another document
+RUN_DEPENDENT_ERRORS = (BrokenProcessPool, TimeoutError, MemoryError, ImportError, OSError)
+
+def cache_extracted_text(content_hash, extraction):
+    if extraction.cancelled():
+        return
+    error = extraction.exception()
+    try:
+        if error is None:
+            cache_store_text(content_hash, extraction.result() or '')
+        elif not isinstance(error, RUN_DEPENDENT_ERRORS):
+            # a document the parsers choke on fails the same way next time
+            cache_store_failure(content_hash, error)
+    except Exception as e:
+        print(f"can't cache text {content_hash}: {e}")
+
+downloads_in_flight = {}        # normalized url -> download of it that isn't finished yet
+extractions_in_flight = {}      # content hash -> extraction of it that isn't finished yet
+extractions_in_flight_lock = Lock()
+
+def shared_extraction(content_hash, filename, document):
+    # copies of one document downloaded at the same time are extracted once
+    with extractions_in_flight_lock:
+        extraction = extractions_in_flight.get(content_hash)
+        if extraction is not None:
+            count('shared extractions')
+            return extraction
+        extraction = Future()
+        extractions_in_flight[content_hash] = extraction
+    extraction.add_done_callback(lambda future: forget_extraction(content_hash, future))
+
+    try:
+        worker_extraction = submit_extraction(filename, document)
+    except BaseException as e:
+        extraction.set_exception(e)
+        raise
+    if CACHE_DIRECTORY:
+        worker_extraction.add_done_callback(lambda future: cache_extracted_text(content_hash, future))
+    worker_extraction.add_done_callback(lambda future: copy_result(future, extraction))
+    return extraction
+
+def forget_extraction(content_hash, extraction):
+    with extractions_in_flight_lock:
+        if extractions_in_flight.get(content_hash) is extraction:
+            del extractions_in_flight[content_hash]
+
+def copy_result(source, target):
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+def completed(text):
+    future = Future()
+    future.set_result(text)
+    return future
+
+http_session = None
+download_executor = None
+download_workers = None     # this process's share of DOWNLOAD_WORKERS, set by init_archive_worker
+host_queues = {}    # downloads waiting for a free slot of their host
+host_active = {}    # downloads of a host running right now in this process
+host_slots = None   # per host limits shared by the archive workers, set by init_archive_worker
+local_host_slots = {}   # per host limits when running outside of process_directory
+host_retries = set()    # hosts waiting for a slot freed by another archive worker
+host_lock = Lock()
+
+def make_http_session():
+    retry = Retry(
+        total=DOWNLOAD_RETRIES,
+        backoff_factor=DOWNLOAD_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("HEAD", "GET"),
+        raise_on_status=False
+    )
+    # keep-alive pool per host, sized to the per host limit
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOADS_PER_HOST, max_retries=retry)
+    session = requests.Session()
+    session.verify = False
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_download_executor():
+    # created lazily, so every process gets its own session and threads
+    global http_session, download_executor
+    if download_executor is None:
+        http_session = make_http_session()
+        download_executor = ThreadPoolExecutor(max_workers=download_workers or DOWNLOAD_WORKERS, thread_name_prefix="download")
+    return download_executor
+
+def submit_download(url, output_filename):
+    # a pool thread only gets the url once its host has a free slot, so a slow host can't take every thread
+    try:
+        download_key = normalize_url(url)
+        host = urlsplit(url).netloc.lower()
+    except ValueError as e:
+        # a malformed href (bad port, broken ipv6 host) fails like any other download, the site goes on
+        count('failed downloads')
+        print(f"can't download {url}: {e}")
+        return completed(None)
+    with host_lock:
+        download = downloads_in_flight.get(download_key)
+        if download is not None:
+            # the same url linked from another site in the same window
+            count('shared downloads')
+            return download
+        download = Future()
+        downloads_in_flight[download_key] = download
+        host_queues.setdefault(host, deque()).append((download, url, output_filename))
+    download.add_done_callback(lambda future: download_finished(download_key, future))
+    dispatch_downloads(host)
+    return download
+
+def download_finished(download_key, download):
+    # stays shared until its extraction is done too
+    extraction = None if download.cancelled() or download.exception() else download.result()
+    if isinstance(extraction, Future):
+        extraction.add_done_callback(lambda future: forget_download(download_key, download))
+    else:
+        forget_download(download_key, download)
+
+def forget_download(download_key, download):
+    with host_lock:
+        if downloads_in_flight.get(download_key) is download:
+            del downloads_in_flight[download_key]
+
+def host_slot(host):
+    # called with host_lock held
+    if host_slots is not None:
+        return host_slots[zlib.crc32(host.encode('utf-8')) % len(host_slots)]
+    if host not in local_host_slots:
+        local_host_slots[host] = BoundedSemaphore(DOWNLOADS_PER_HOST)
+    return local_host_slots[host]
+
+def dispatch_downloads(host):
+    executor = get_download_executor()
+    with host_lock:
+        queue = host_queues.get(host)
+        slot = host_slot(host)
+        while queue and slot.acquire(False):
+            download, url, output_filename = queue.popleft()
+            host_active[host] = host_active.get(host, 0) + 1
+            executor.submit(run_download, host, download, url, output_filename)
+        if queue is not None and not queue:
+            del host_queues[host]
+        elif queue and not host_active.get(host) and host not in host_retries:
+            # the slots are taken by other archive workers, nothing in this one will free them
+            retry = Timer(HOST_RETRY_DELAY, retry_downloads, (host,))
+            retry.daemon = True
+            host_retries.add(host)
+            retry.start()
+
+def retry_downloads(host):
+    with host_lock:
+        host_retries.discard(host)
+    dispatch_downloads(host)
+
+def run_download(host, download, url, output_filename):
+    try:
+        download.set_result(download_and_extract_text(url, output_filename))
+    except BaseException as e:
+        download.set_exception(e)
+    finally:
+        with host_lock:
+            host_slot(host).release()
+            host_active[host] -= 1
+            if not host_active[host]:
+                del host_active[host]
+        dispatch_downloads(host)
+
+def rejection_reason(status_code, content_length, content_type):
+    if status_code not in (200, 206):
+        return f"status {status_code}"
+    if content_length is not None and int(content_length) > MAX_DOWNLOAD_SIZE:
+        return f"size {naturalsize(content_length)}"
+    if content_type and content_type.lower().startswith(REJECTED_CONTENT_TYPES):
+        return f"content type {content_type}"
+    return None
+
+def probe_download(url):
+    response = http_session.head(url, allow_redirects=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    content_length = response.headers.get('Content-Length')
+
+    if response.status_code in (405, 501) or content_length is None:
+        # server doesn't answer HEAD properly, ask for the first byte and read the total size from Content-Range
+        with http_session.get(
+                url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+        ) as response:
+            content_length = response.headers.get('Content-Length')
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code == 206 and '/' in content_range and not content_range.endswith('/*'):
+                content_length = content_range.rsplit('/', 1)[1]
+
+    return rejection_reason(response.status_code, content_length, response.headers.get('Content-Type'))
+
+def read_body(response):
+    # never holds more than MAX_DOWNLOAD_SIZE of a body in memory
+    body = bytearray()
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        if len(body) + len(chunk) > MAX_DOWNLOAD_SIZE:
+            return None
+        body += chunk
+    return body
+
+def record_fetch_stage(url, status_code, size, fetch_started):
+    seconds = time.perf_counter() - fetch_started
+    record_time('fetch', seconds)
+    record_fetch(url, status_code, size, seconds)
+
+def download_and_extract_text(url, output_filename):
+    print(f"downloading {url} as {output_filename}")
+    fetch_started = None
+    try:
+        if PROBE_BEFORE_DOWNLOAD:
+            reason = probe_download(url)
+            if reason:
+                print(f"skip {url}: {reason}")
+                return
+
+        cache_key = normalize_url(url)
+        cached = cache_lookup(cache_key) if CACHE_DIRECTORY else None
+        headers = {}
+        if cached:
+            etag, last_modified, content_hash = cached
+            text = cached_text(content_hash)
+            failure = cached_failure(content_hash) if text is None else None
+            if text is not None or failure is not None:
+                # revalidate, the body is only sent if the document changed
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+        fetch_started = time.perf_counter()
+        with http_session.get(url, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            if response.status_code == 304 and headers:
+                record_fetch_stage(url, 304, 0, fetch_started)
+                if failure is not None:
+                    count('cached failures')
+                    print(f"skip {url}: not modified, extraction failed before with {failure}")
+                    return
+                count('cache hits')
+                print(f"{url} not modified, text taken from cache")
+                return completed(text)
+
+            file_len = response.headers.get('Content-Length')
+            print(f"Response: {response}, {naturalsize(file_len or 0)}")
+
+            # headers are checked before a single byte of the body is read
+            reason = rejection_reason(response.status_code, file_len, response.headers.get('Content-Type'))
+            if reason:
+                record_fetch_stage(url, response.status_code, 0, fetch_started)
+                count('rejected downloads')
+                print(f"skip {url}: {reason}")
+                return
+
+            document = read_body(response)
+            if document is None:
+                record_fetch_stage(url, response.status_code, MAX_DOWNLOAD_SIZE, fetch_started)
+                count('rejected downloads')
+                print(f"skip {url}: body is bigger than {naturalsize(MAX_DOWNLOAD_SIZE)}")
+                return
+            record_fetch_stage(url, response.status_code, len(document), fetch_started)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        # the same document behind another url (or a changed url with the same contents) is parsed only once
+        content_hash = sha256(document).hexdigest()
+        if CACHE_DIRECTORY:
+            cache_store_url(cache_key, etag, last_modified, content_hash)
+            text = cached_text(content_hash)
+            if text is not None:
+                count('cache hits')
+                print(f"text of {url} taken from cache")
+                return completed(text)
+            failure = cached_failure(content_hash)
+            if failure is not None:
+                count('cached failures')
+                print(f"skip {url}: extraction failed before with {failure}")
+                return
+
+        return shared_extraction(content_hash, output_filename, document)
     except (Exception, SSLError) as e:
+        if fetch_started is not None:
+            record_fetch_stage(url, type(e).__name__, 0, fetch_started)
+        count('failed downloads')
         print(e)
 
 RU_CONTENTS_PATTERN = re.compile(r"[\u0400-\u04FF]")
+TAG_ATTRIBUTE_CHAR = r"""(?:"[^"]*"|'[^']*'|[^'">])"""     # a quoted value is taken whole, it may contain >
+# comments and script/style bodies are not markup for html.parser, unclosed ones run to the end of the page
+HIDDEN_HTML_PATTERN = re.compile(
+    r"<!--.*?(?:-->|\Z)|<(script|style)\b" + TAG_ATTRIBUTE_CHAR + r"*>.*?(?:</\1\s*>|\Z)",
+    re.IGNORECASE | re.DOTALL
+)
+LINK_PATTERN = re.compile(
+    r"<a\s" + TAG_ATTRIBUTE_CHAR + r"*?(?<![\w-])href\s*=\s*"
+    r"""(?:"([^"]*)"|'([^']*)'|([^\s>]*))""" + TAG_ATTRIBUTE_CHAR + r"*>"   # opening tag with href
+    r"[^<]*(?:<(?!/?a[\s>])[^<]*)*",                                      # contents up to the next <a> or </a>
+    re.IGNORECASE
+)
+FILE_EXT_PATTERN = re.compile("(?:" + "|".join(re.escape(ex) for ex in sorted(FILE_EXT)) + r")\Z")
+ANCHOR_TEXT_PATTERN = re.compile("|".join(re.escape(anch_text) for anch_text in sorted(ANCHOR_TEXT)))
+
+def decode_html(html_content):
+    try:
+        return html_content.decode('utf-8')
+    except UnicodeDecodeError:
+        # most of the non utf-8 russian sites are windows-1251
+        return html_content.decode('cp1251', errors='replace')
+
+def extract_links(html_content, inner_html_filename):
+    # one regex pass over the page instead of building a tree
+    count('pages')
+    with timed('html scan'):
+        html_text = decode_html(html_content)
+
+        if not RU_CONTENTS_PATTERN.search(html_text):
+            count('pages without russian text')
+            print(f"{inner_html_filename} doesnt contain russian text, will skip it")
+            return []
+
+        html_text = HIDDEN_HTML_PATTERN.sub('', html_text)
+
+        resulting_links = []
+        for match in LINK_PATTERN.finditer(html_text):
+            href = unescape(match.group(1) or match.group(2) or match.group(3) or '')
+            if FILE_EXT_PATTERN.search(href):
+                resulting_links.append((href, match.group(0)))
+    count('file links', len(resulting_links))
+
+    # a page with few file links is taken as is, keywords only narrow down pages with many of them
+    if len(resulting_links) <= 10:
+        return [href for href, _ in resulting_links]
+
+    #print(f"too much links: {resulting_links}")
+    with timed('link filter'):
+        links = [href for href, anchor in resulting_links if ANCHOR_TEXT_PATTERN.search(unescape(anchor))]
+    count('file links filtered out', len(resulting_links) - len(links))
+    print(f"links filtered by keywords: {links}")
+    return links
 
 def process_html_file(original_arch_filepath, zip_arch_file: zipfile.ZipFile, inner_html_filename):
     with zip_arch_file.open(inner_html_filename) as html_file:
@@ -90,149 +891,345 @@ def process_html_file(original_arch_filepath, zip_arch_file: zipfile.ZipFile, in
         #print(f"processing {original_arch_filepath}, {inner_html_filename}, contents: {html_content[:50]}")
 
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            return extract_links(html_content, inner_html_filename)
+        except Exception as e:
+            print(e)
+            return []
 
-            if not RU_CONTENTS_PATTERN.search(str(soup)):
-                print(f"{inner_html_filename} doesnt contain russian text, will skip it")
-                return []
 
-            links = soup.find_all('a', href=True)
-            resulting_links = []
+progress_connection = None
 
-            for link in links:
-                for ex in FILE_EXT:
-                    if link['href'].endswith(ex):
-                        resulting_links.append(link)
+def get_progress():
+    # progress is shared by all archive workers, sqlite keeps every record atomic
+    global progress_connection
+    if progress_connection is None:
+        connection = sqlite3.connect(PROGRESS_DB, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed (kind TEXT, path TEXT, finished REAL, PRIMARY KEY (kind, path))"
+        )
+        if connection.execute("SELECT 1 FROM processed LIMIT 1").fetchone() is None:
+            import_legacy_progress(connection)
+        progress_connection = connection
+    return progress_connection
 
-            links = []
-            if len(resulting_links) > 10:
-                #print(f"too much links: {resulting_links}")
-                for link in resulting_links:
-                    for anch_text in ANCHOR_TEXT:
-                        if anch_text in str(link):
-                            links.append(link)
-                print(f"links filtered by keywords: {links}")
-
-            return links
-        except Exception as e:
-            print(e)
-            return []
+def import_legacy_progress(connection):
+    for kind, filepath in LEGACY_PROGRESS_FILES.items():
+        if os.path.exists(filepath):
+            with open(filepath, encoding="utf-8") as progress_file:
+                paths = set(progress_file.read().splitlines())
+            print(f"importing {len(paths)} processed archives from {filepath}")
+            connection.executemany(
+                "INSERT OR IGNORE INTO processed (kind, path, finished) VALUES (?, ?, ?)",
+                [(kind, path, time.time()) for path in paths if path]
+            )
+
+def is_processed(kind, path):
+    return get_progress().execute(
+        "SELECT 1 FROM processed WHERE kind = ? AND path = ?", (kind, path)
+    ).fetchone() is not None
+
+def mark_processed(kind, path):
+    get_progress().execute(
+        "INSERT OR REPLACE INTO processed (kind, path, finished) VALUES (?, ?, ?)", (kind, path, time.time())
+    )
 
+def forget_processed(kind, directory):
+    # substr instead of LIKE, paths may contain % and _
+    prefix = os.path.join(directory, '')
+    get_progress().execute(
+        "DELETE FROM processed WHERE kind = ? AND substr(path, 1, ?) = ?", (kind, len(prefix), prefix)
+    )
 
-def process_zip(zip_filepath, processed_site_archs_file, processed_site_arcs: set):
-    if zip_filepath in processed_site_arcs:
+
+def process_zip(zip_filepath, pending_zips: deque = None, zip_file=None):
+    # zip_file is an open file with the archive contents when it doesn't exist at zip_filepath (yet)
+    if is_processed('site', zip_filepath) or is_processed('broken site', zip_filepath):
         print(f"skip processing of {zip_filepath}, it already was processed")
+        if zip_file is not None:
+            zip_file.close()
         return
 
     print(f"processing zip file: {zip_filepath}")
-    with zipfile.ZipFile(zip_filepath, mode="a") as zip_arch_file:
-        zip_arch_file.testzip()
-
-        links = []
-        for file_info in zip_arch_file.infolist():
-            inner_filename = file_info.filename
-            if inner_filename.endswith(".html"):
-                links = links + process_html_file(zip_filepath, zip_arch_file, inner_filename)
-
-        for link in set(links[:10]):
-            href = link['href']
-            target_directory = os.path.split(zip_arch_file.filename)[0]
-            target_filename = os.path.basename(href)
-
-            if href.startswith('https://drive.google.com'):
-                print(f"google drive link: {href}")
-                # file_id = re.search(r'/file/d/([a-zA-Z0-9-_]+)/', href)
-                # if file_id:
-                #     gdd.download_file_from_google_drive(file_id.group(1), os.path.basename(href))
-                #     download_and_extract_text(os.path.basename(href), os.path.basename(href))
-            elif href.startswith("http"):
-                download_and_extract_text(href, target_directory, target_filename, delete_intermidiate_file=True)
-            else:
-                abs_href = os.path.split(target_directory)[1] + href
-                #download_and_extract_text("http://" + abs_href, target_directory, "http_" + target_filename, delete_intermidiate_file=True)
-                #download_and_extract_text("https://" + abs_href, target_directory, "https_" + target_filename, delete_intermidiate_file=True)
-
-
-        for dir_path, dir_name, filenames in os.walk(os.path.dirname(zip_filepath)):
-            for file_name in filenames:
-                #print(f"postprocessing {dir_path}, {file_name}")
-                if file_name.endswith("txt"):
-                    file_path = os.path.join(dir_path, file_name)
-                    print(f"storing {file_path} back to {zip_arch_file}")
-                    zip_arch_file.write(file_path, file_name)
-                    os.remove(file_path)
-
-    processed_site_archs_file.write(zip_filepath + "\n")
-    processed_site_archs_file.flush()
-                
-
-def process_rar(
-        filepath,
-        processed_site_archs_file, processed_site_arcs: set
-):
+    try:
+        with zipfile.ZipFile(zip_file or zip_filepath) as zip_arch_file:
+            with timed('archive open'):
+                zip_arch_file.testzip()
+
+            links = []
+            for file_info in zip_arch_file.infolist():
+                inner_filename = file_info.filename
+                if inner_filename.endswith(".html"):
+                    links = links + process_html_file(zip_filepath, zip_arch_file, inner_filename)
+    except zipfile.BadZipFile as e:
+        # it will be just as broken next time, so it isn't tried again
+        count('broken sites')
+        print(f"skip {zip_filepath}, broken zip: {e}")
+        mark_processed('broken site', zip_filepath)
+        if zip_file is not None:
+            zip_file.close()
+        return
+
+    downloads = []
+    for href in set(links[:10]):
+        target_filename = os.path.basename(href)
+
+        if href.startswith('https://drive.google.com'):
+            print(f"google drive link: {href}")
+            # file_id = re.search(r'/file/d/([a-zA-Z0-9-_]+)/', href)
+            # if file_id:
+            #     gdd.download_file_from_google_drive(file_id.group(1), os.path.basename(href))
+            #     download_and_extract_text(os.path.basename(href), os.path.basename(href))
+        elif href.startswith("http"):
+            downloads.append((target_filename, submit_download(href, target_filename)))
+        else:
+            abs_href = os.path.split(os.path.dirname(zip_filepath))[1] + href
+            #downloads.append(("http_" + target_filename, submit_download("http://" + abs_href, "http_" + target_filename)))
+            #downloads.append(("https_" + target_filename, submit_download("https://" + abs_href, "https_" + target_filename)))
+
+    if pending_zips is None or not downloads:
+        # nothing to wait for, a site without downloads doesn't hold its zip in the window
+        finish_zip(zip_filepath, downloads, zip_file)
+        return
+
+    # let downloads of the next archives start while this one is still in flight
+    pending_zips.append((zip_filepath, downloads, zip_file))
+    while len(pending_zips) > MAX_PENDING_ZIPS:
+        finish_pending_zip(pending_zips)
+
+
+def finish_zip(zip_filepath, downloads, zip_file=None):
+    texts = [(os.path.splitext(filename)[0] + '.txt', document_text(download)) for filename, download in downloads]
+    texts = [(txt_filename, text) for txt_filename, text in texts if text]
+
+    with timed('zip write'):
+        write_texts(zip_filepath, texts, zip_file)
+
+    count('sites')
+    mark_processed('site', zip_filepath)
+    maybe_report_progress()
+
+
+def write_texts(zip_filepath, texts, zip_file=None):
+    if texts:
+        with zipfile.ZipFile(zip_file or zip_filepath, mode="a") as zip_arch_file:
+            stored = set(zip_arch_file.namelist())
+            for txt_filename, text in texts:
+                # links to different files with the same name, the first one wins
+                if txt_filename in stored:
+                    continue
+                print(f"storing {txt_filename} to {zip_filepath}")
+                zip_arch_file.writestr(txt_filename, text)
+                stored.add(txt_filename)
+
+    if zip_file is not None:
+        # a streamed site zip is only written out when texts were added, otherwise the rar already has it
+        if texts:
+            save_zip_file(zip_file, zip_filepath)
+        zip_file.close()
+
+
+def save_zip_file(zip_file, zip_filepath):
+    os.makedirs(os.path.dirname(zip_filepath), exist_ok=True)
+    tmp_filepath = zip_filepath + ".tmp"
+    zip_file.seek(0)
+    with open(tmp_filepath, 'wb') as file:
+        shutil.copyfileobj(zip_file, file)
+    os.replace(tmp_filepath, zip_filepath)
+
+
+failed_sites = 0     # sites of this worker that failed to finish, a rar with one of them isn't marked processed
+
+def finish_pending_zip(pending_zips: deque):
+    global failed_sites
+    zip_filepath, downloads, zip_file = pending_zips.popleft()
+    try:
+        finish_zip(zip_filepath, downloads, zip_file)
+    except Exception as e:
+        # the site isn't marked processed and is tried again by the next run
+        failed_sites += 1
+        count('failed sites')
+        print(f"failed processing of {zip_filepath}: {e}")
+        if zip_file is not None:
+            zip_file.close()
+
+def drain_pending_zips(pending_zips: deque):
+    while pending_zips:
+        finish_pending_zip(pending_zips)
+
+
+def rar_scratch_directory(filepath):
+    # stable between runs, so site zips inside keep their paths in the progress db
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(SCRATCH_DIRECTORY, f"{name}-{sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()[:8]}")
+
+def process_rar(filepath, pending_zips: deque = None):
     print(f"processing rar file: {filepath}")
-    tmp_dir = "./tmp"
+    tmp_dir = rar_scratch_directory(filepath)
 
     if os.path.exists(tmp_dir):
+        # texts written into these site zips by an interrupted run go away with them,
+        # so their sites must be processed again
+        forget_processed('site', tmp_dir)
         shutil.rmtree(tmp_dir)
 
-    os.mkdir(tmp_dir)
-    patoolib.extract_archive(filepath, outdir=tmp_dir)
+    os.makedirs(tmp_dir)
+    with timed('archive open'):
+        patoolib.extract_archive(filepath, outdir=tmp_dir)
 
     for root, _, files in os.walk(tmp_dir):
         for file in files:
             if file.endswith('.zip'):
                 arch_filepath = os.path.join(root, file)
-                process_zip(arch_filepath, processed_site_archs_file, processed_site_arcs)
+                process_zip(arch_filepath, pending_zips)
 
     #shutil.rmtree(tmp_dir)
 
-def process_directory(
-        directory,
-        processed_archs_file, processed_arcs:set,
-        processed_site_archs_file, processed_site_arcs:set
-):
+def rar_member_path(tmp_dir, member_filename):
+    # the way unrar and patool extract it: no absolute paths, drive letters or ..
+    parts = [part for part in member_filename.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or ':' in parts[0]:
+        return None
+    return os.path.join(tmp_dir, *parts)
+
+def process_rar_streaming(filepath, pending_zips: deque = None):
+    print(f"processing rar file: {filepath}")
+    tmp_dir = rar_scratch_directory(filepath)
+    os.makedirs(SCRATCH_DIRECTORY, exist_ok=True)
+
+    with rarfile.RarFile(filepath) as rar_arch_file:
+        for member in rar_arch_file.infolist():
+            if member.is_dir() or not member.filename.endswith('.zip'):
+                continue
+
+            # same path as after extraction, so the progress db works for both modes
+            arch_filepath = rar_member_path(tmp_dir, member.filename)
+            if arch_filepath is None:
+                count('broken sites')
+                print(f"skip {member.filename} in {filepath}, it points outside of the archive")
+                continue
+            if is_processed('site', arch_filepath) or is_processed('broken site', arch_filepath):
+                print(f"skip processing of {arch_filepath}, it already was processed")
+                continue
+
+            zip_file = tempfile.SpooledTemporaryFile(max_size=RAR_SPILL_SIZE, dir=SCRATCH_DIRECTORY)
+            try:
+                with timed('archive open'), rar_arch_file.open(member) as rar_member:
+                    shutil.copyfileobj(rar_member, zip_file)
+                zip_file.seek(0)
+            except rarfile.Error as e:
+                # a damaged member stays damaged, the other sites of the rar are still processed
+                zip_file.close()
+                count('broken sites')
+                print(f"skip {arch_filepath}, can't read it from {filepath}: {e}")
+                mark_processed('broken site', arch_filepath)
+                continue
+            except Exception:
+                zip_file.close()
+                raise
+
+            try:
+                process_zip(arch_filepath, pending_zips, zip_file)
+            except Exception:
+                zip_file.close()
+                raise
+
+def init_archive_worker(shared_host_slots=None):
+    # sqlite connections and pools must not be shared with the parent after fork,
+    # a forked pool has no threads or processes behind it
+    global progress_connection, cache_connection, http_session, download_executor, host_queues, host_active
+    global download_workers, host_slots, local_host_slots, host_retries
+    global downloads_in_flight, extractions_in_flight, failed_sites
+    global extraction_executor, extraction_slots, metrics
+    metrics = new_metrics()
+    progress_connection = None
+    cache_connection = None
+    http_session = None
+    download_executor = None
+    download_workers = max(1, DOWNLOAD_WORKERS // ARCHIVE_WORKERS)
+    host_queues = {}
+    host_active = {}
+    host_slots = shared_host_slots
+    local_host_slots = {}
+    host_retries = set()
+    downloads_in_flight = {}
+    extractions_in_flight = {}
+    failed_sites = 0
+    extraction_executor = None
+    extraction_slots = BoundedSemaphore(EXTRACT_QUEUE_SIZE)
+
+def process_archives(arch_filepaths):
+    # runs in an archive worker process
+    pending_zips = deque()
+    try:
+        for arch_filepath in arch_filepaths:
+            try:
+                process_archive(arch_filepath, pending_zips)
+            except Exception as e:
+                # the archive isn't marked processed and is picked up by the next run, the rest of the task goes on
+                count('failed archives')
+                print(f"failed processing of {arch_filepath}: {e}")
+    finally:
+        drain_pending_zips(pending_zips)
+        report_extraction_stats()
+        # a worker process waits for its child processes before it can exit
+        shutdown_extraction_executor()
+    return take_metrics()
+
+def process_archive(arch_filepath, pending_zips: deque):
+    if not arch_filepath.endswith('.rar'):
+        process_zip(arch_filepath, pending_zips)
+        return
+
+    failed_before = failed_sites
+    if RAR_STREAMING:
+        process_rar_streaming(arch_filepath, pending_zips)
+    else:
+        process_rar(arch_filepath, pending_zips)
+    # the rar only counts as processed once all its sites are done
+    drain_pending_zips(pending_zips)
+    if failed_sites != failed_before:
+        print(f"{arch_filepath} has failed sites, it will be processed again by the next run")
+        return
+    mark_processed('archive', arch_filepath)
+    count('archives')
+
+def process_directory(directory):
+    tasks = []
+    zips = []
     for root, _, files in os.walk(directory):
         for file in files:
             arch_filepath = os.path.join(root, file)
 
             if file.endswith('.rar'):
-                arch_filepath = os.path.join(root, file)
-                if arch_filepath in processed_arcs:
+                if is_processed('archive', arch_filepath):
                     print(f"skip processing of {arch_filepath}, it already was processed")
                     continue
-
-                process_rar(arch_filepath, processed_site_archs_file, processed_site_arcs)
-                processed_archs_file.write(arch_filepath + "\n")
-                processed_archs_file.flush()
+                tasks.append([arch_filepath])
             elif file.endswith('.zip'):
-                process_zip(arch_filepath, processed_site_archs_file, processed_site_arcs)
-
-base_directory = "./data/results"
-processed_archives_file_path = "./processed_archives.txt"
-processed_site_archives_file_path = "./processed_site_archives.txt"
+                zips.append(arch_filepath)
 
-processed_arcs = set()
-processed_site_arcs = set()
+    tasks += [zips[i:i + ZIPS_PER_TASK] for i in range(0, len(zips), ZIPS_PER_TASK)]
+    print(f"{len(tasks)} tasks for {ARCHIVE_WORKERS} archive workers")
 
-if os.path.exists(processed_archives_file_path):
-    with open(processed_archives_file_path) as processed_arcs_file:
-        processed_arcs = set(processed_arcs_file.read().splitlines())
-        # print(f"processed_arcs: {processed_arcs}")
+    # DOWNLOADS_PER_HOST holds for all archive workers together, not for each of them
+    shared_host_slots = [multiprocessing.BoundedSemaphore(DOWNLOADS_PER_HOST) for _ in range(HOST_SLOT_GROUPS)]
+    with ProcessPoolExecutor(
+        max_workers=ARCHIVE_WORKERS, initializer=init_archive_worker, initargs=(shared_host_slots,)
+    ) as executor:
+        futures = {executor.submit(process_archives, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                merge_metrics(future.result())
+            except Exception as e:
+                # the rest of the task isn't marked processed and is picked up by the next run
+                print(f"failed processing of {futures[future][0]}: {e}")
 
-if os.path.exists(processed_site_archives_file_path):
-    with open(processed_site_archives_file_path) as processed_site_arcs_file:
-        processed_site_arcs = set(processed_site_arcs_file.read().splitlines())
-        # print(f"processed_site_arcs: {processed_site_arcs}")
+if __name__ == "__main__":
+    base_directory = "./data/results"
 
-
-with open(processed_archives_file_path, "a", encoding="utf-8") as processed_arcs_file:
-    with open(processed_site_archives_file_path, "a", encoding="utf-8") as processed_site_arcs_file:
-        process_directory(
-            base_directory,
-            processed_arcs_file, processed_arcs,
-            processed_site_arcs_file, processed_site_arcs
-        )
+    process_directory(base_directory)
+    write_run_report()
 
 # todo
 # * if site links more than 10, filter by keywords - done